@@ -1,11 +1,145 @@
 # Sage code for converting a GeoGebra figure into a SageMath graph, for plotting the resulting SageMath graph, and for exporting a SageMath graph into a GeoGebra figure.
 
+import concurrent.futures
+import functools
+import io
+import os
 import zipfile
-import xml.etree.ElementTree as ET
+import xml.etree.ElementTree as ET  # uses the C accelerator (_elementtree) automatically
 
 import sage.all
 
 
+@functools.lru_cache(maxsize=8)
+def _read_ggb_xml(ggb_filename,mtime,size):
+    '''Returns the decompressed geogebra.xml of a GeoGebra file; mtime and size are only used as part of the cache key.'''
+    with zipfile.ZipFile(ggb_filename,'r') as f:
+        return f.read("geogebra.xml")
+
+
+def _parse_ggb(ggb_filename):
+    '''
+    Reads the points and line segments of a GeoGebra file, without building a SageMath graph.
+    Returns the list of vertex information dicts, the pos dictionary, and the adjacency as a dict of dicts whose values are the edge information.
+    '''
+    
+    vertex_labels=[]  # vertices, as labels
+    vertex_information=[]  # each vertex will have a dict of information (such as label, color, etc) about that vertex
+    v=0  # current vertex number
+    pos=dict()
+    segments=[]  # (first endpoint label, second endpoint label, segment label) for each Segment command
+    segment_information=dict()  # information about each segment element, keyed by segment label
+
+    # bind the names used for every element to locals, so the parsing loop does not look them up repeatedly
+    append_vertex_label=vertex_labels.append
+    append_vertex_information=vertex_information.append
+    append_segment=segments.append
+    _int=int
+    _float=float
+
+    if isinstance(ggb_filename,(str,os.PathLike)):
+        # the decompressed XML of a named file is cached, so that reading an unchanged file again skips decompression;
+        # the modification time and size are part of the cache key, so an edited file is read afresh.
+        ggb_filename=os.path.abspath(ggb_filename)
+        stat=os.stat(ggb_filename)
+        xml=_read_ggb_xml(ggb_filename,stat.st_mtime_ns,stat.st_size)
+    else:  # an open file object, which zipfile also accepts; it cannot be cached
+        with zipfile.ZipFile(ggb_filename,'r') as f:
+            xml=f.read("geogebra.xml")
+    
+    # read the construction in a single pass. Only direct children of the top-level construction are interpreted
+    # (a macro has a construction of its own); depth counts the open tags, so the root is at depth 1.
+    # Each top-level section and each child of the construction is detached from the tree once it has been read,
+    # so the tree does not grow with the construction; the decompressed XML itself is still held in memory.
+    root=None
+    construction=None
+    depth=0
+    with io.BytesIO(xml) as buf:
+        for event,elt in ET.iterparse(buf,events=("start","end")):
+            if event=='start':
+                depth+=1
+                if depth==1:
+                    root=elt
+                elif depth==2 and elt.tag=='construction':
+                    construction=elt
+                continue
+            depth-=1
+            if depth==1:  # end of a top-level section
+                root.remove(elt)
+                if elt is construction:
+                    break  # the rest of the file holds nothing that becomes part of the graph
+                continue
+            if depth!=2 or construction is None:
+                continue  # not a direct child of the top-level construction
+            
+            tag=elt.tag
+            if tag=='element':
+                elt_attrib=elt.attrib
+                elt_find=elt.find
+                elt_type=elt_attrib['type']
+                if elt_type=='point':
+                    # interpret points as vertices
+                    label=elt_attrib['label']
+                    append_vertex_label(label)
+                    coords=elt_find('coords').attrib
+                    pos[v]=(_float(coords['x']),_float(coords['y']))
+                    
+                    # save vertex information, such as label, color, etc, in a dict
+                    info=dict()
+                    info['label']=label
+                    color=elt_find('objColor').attrib
+                    info['color']=(_int(color['r']),
+                                   _int(color['g']),
+                                   _int(color['b']),
+                                   _float(color['alpha']))
+                    info['size' ]=_int(elt_find('pointSize').attrib['val'])
+                    info['style']=_int(elt_find('pointStyle').attrib['val'])
+                    append_vertex_information(info)
+                    
+                    v+=1
+                elif elt_type=='segment':
+                    # the edge properties are stored in the segment element, not in the Segment command
+                    label=elt_attrib['label']
+                    info=dict()
+                    info['label']=label
+                    color=elt_find('objColor').attrib
+                    info['color']=(_int(color['r']),
+                                   _int(color['g']),
+                                   _int(color['b']),
+                                   _float(color['alpha']))
+                    info['thickness']=_int(elt_find('lineStyle').attrib['thickness'])
+                    segment_information[label]=info
+            elif tag=='command':
+                if elt.attrib['name']=='Segment':
+                    endpts=elt.find('input').attrib
+                    append_segment((endpts['a0'],endpts['a1'],elt.find('output').attrib['a0']))
+            construction.remove(elt)
+
+    # map each point label to its vertex number, so that segment endpoints are found without scanning vertex_labels
+    label_to_index={lbl:i for i,lbl in enumerate(vertex_labels)}
+    
+    # interpret line segments as edges; the adjacency is collected in a dict of dicts so the graph is built in one call.
+    # the edge properties are stored in the segment element rather than the command, so look them up by the segment label.
+    adjacency={i:dict() for i in range(v)}
+    for a0,a1,label in segments:
+        u=label_to_index[a0]  # first endpoint of this edge
+        w=label_to_index[a1]  # second endpoint of the edge
+        adjacency[u][w]=adjacency[w][u]=segment_information.get(label,label)
+    
+    return vertex_information,pos,adjacency
+
+
+def _build_graph(vertex_information,pos,adjacency):
+    '''Builds the SageMath graph from the output of _parse_ggb.'''
+    G=sage.graphs.graph.Graph(adjacency,format='dict_of_dicts',multiedges=False,pos=pos)  # simple graph, even when there are no edges to infer that from
+    
+    # store information for each vertex in the Sage graph
+    for i,info in enumerate(vertex_information):
+        G.set_vertex(i,info)
+    
+    return G
+
+
 def geogebra_to_graph(ggb_filename):
     '''
     Converts a GeoGebra file into a SageMath graph.
@@ -21,75 +155,29 @@ def geogebra_to_graph(ggb_filename):
     The position of the points is also stored in the graph's pos dictionary for later plotting.
     '''
     
-    with zipfile.ZipFile(ggb_filename,'r') as f:
-        root=ET.fromstring(f.read("geogebra.xml"))
-        # the root tag is geogebra
-    
-    c=root.find('construction')
-
-    vertex_labels=[]  # vertices, as labels
-    vertex_information=[]  # each vertex will have a dict of information (such as label, color, etc) about that vertex
-    v=0  # current vertex number
-    pos=dict()
+    return _build_graph(*_parse_ggb(ggb_filename))
 
-    # interpret points as vertices
-    for elt in c.findall('element'):
-        if elt.attrib['type']=='point':
-            vertex_labels.append(elt.attrib['label'])
-            coords=elt.find('coords')
-            pos[v]=(float(coords.attrib['x']),float(coords.attrib['y']))
-            
-            # save vertex information, such as label, color, etc, in a dict
-            info=dict()
-            info['label']=vertex_labels[-1]
-            color=elt.find('objColor')
-            info['color']=(int(color.attrib['r']),
-                           int(color.attrib['g']),
-                           int(color.attrib['b']),
-                           float(color.attrib['alpha']))
-            info['size' ]=int(elt.find('pointSize').attrib['val'])
-            info['style']=int(elt.find('pointStyle').attrib['val'])
-            vertex_information.append(info)
-            
-            v+=1
 
-    G=sage.graphs.graph.Graph()
-    G.add_vertices(range(v))
-    G.set_pos(pos)
-    
-    # store information for each vertex in the Sage graph
-    for i in range(v):
-        G.set_vertex(i,vertex_information[i])
-
-    # interpret line segments as edges
-    for elt in c.findall('command'):
-        if elt.attrib['name']=='Segment':
-            e=[]
-            endpts=elt.find('input')
-            e.append(vertex_labels.index(endpts.attrib['a0']))  # first endpoint of this edge
-            e.append(vertex_labels.index(endpts.attrib['a1']))  # second endpoint of the edge
-            label=elt.find('output').attrib['a0']
-            G.add_edge(e)
-            G.set_edge_label(e[0],e[1],label)
-    
-    # we need to extract the edge properties from a different object
-    for e in G.edges(sort=False):
-        label=G.edge_label(e[0],e[1])
-        
-        for elt in c.findall('element'):
-            if elt.attrib['type']=='segment' and elt.attrib['label']==label:
-                # save vertex information, such as label, color, etc, in a dict
-                info=dict()
-                info['label']=label
-                color=elt.find('objColor')
-                info['color']=(int(color.attrib['r']),
-                               int(color.attrib['g']),
-                               int(color.attrib['b']),
-                               float(color.attrib['alpha']))
-                info['thickness']=int(elt.find('lineStyle').attrib['thickness'])
-                G.set_edge_label(e[0],e[1],info)
+def geogebra_to_graphs(ggb_filenames,max_workers=None):
+    '''
+    Converts several GeoGebra files into SageMath graphs, as geogebra_to_graph does, and returns the list of graphs in the same order.
+    The files are read in a thread pool of max_workers threads (the ThreadPoolExecutor default if None);
+    only the decompression releases the GIL and overlaps between files, while parsing the XML runs one thread at a time.
+    The SageMath graphs are then built one at a time in the calling thread.
     
-    return G
+    Named files go through the same cache of decompressed XML as geogebra_to_graph, which holds only the 8 most recently read files,
+    so a batch of more than 8 files evicts every earlier entry.
+    '''
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        parsed=list(executor.map(_parse_ggb,ggb_filenames))
+    return [_build_graph(*p) for p in parsed]
+
+
+def _rgb_of(info):
+    '''Returns the (r,g,b) part of the color stored in a vertex object or edge label, or None if there is no such color.'''
+    if isinstance(info,dict) and 'color' in info:
+        return info['color'][:3]
+    return None  # object is not a dictionary, or does not have 'color'
 
 
 def geogebra_graph_plot(G):
@@ -104,114 +192,97 @@ def geogebra_graph_plot(G):
     colors[(0,0,0)]=other_e='black'  # the rest of the edges
     colors[(255,0,255)]='magenta'  # magenta in geogebra; vertices to recolor
     
+    # extract the (r,g,b) part of each color once, up front; None if there is no color to use
+    vertex_information=G.get_vertices()  # objects associated with all vertices, fetched in one call
+    vertex_rgb=[(v,_rgb_of(vertex_information[v])) for v in G.vertices(sort=False)]
+    edge_rgb=[(e,_rgb_of(e[2])) for e in G.edges(sort=False)]  # the edge label is already part of the edge triple
+    
+    # None is not a key of colors, so uncolored vertices and edges fall through to the default
     vertex_colors=dict()
     for color in colors.values():
         vertex_colors[color]=[]
-    for v in G.vertices(sort=False):
-        try:
-            color_of_v=G.get_vertex(v)['color'][:3]
-        except TypeError:  # label is not a dictionary, or does not have 'color'
-            color_of_v=other_v
-        if color_of_v in colors:
-            vertex_colors[colors[color_of_v]].append(v)
-        else:
-            vertex_colors[other_v].append(v)
+    for v,rgb in vertex_rgb:
+        vertex_colors[colors.get(rgb,other_v)].append(v)
     
     edge_colors=dict()
     for color in colors.values():
         edge_colors[color]=[]
-    for e in G.edges(sort=False):
-        try:
-            color_of_e=G.edge_label(e[0],e[1])['color'][:3]
-        except TypeError:  # label is not a dictionary, or does not have 'color'
-            color_of_e=other_e
-        if color_of_e in colors:
-            edge_colors[colors[color_of_e]].append(e)
-        else:
-            edge_colors[other_e].append(e)
+    for e,rgb in edge_rgb:
+        edge_colors[colors.get(rgb,other_e)].append(e)
     
     return(G.plot(vertex_colors=vertex_colors,edge_colors=edge_colors))
 
 
+# the view settings are the same for every exported file, so they are built once, when the module is loaded
+_EUCLIDIAN_VIEW=ET.Element('euclidianView')
+ET.SubElement(_EUCLIDIAN_VIEW,'viewNumber',viewNo="1")
+#ET.SubElement(_EUCLIDIAN_VIEW,'size',width="2339",height="1196")
+#ET.SubElement(_EUCLIDIAN_VIEW,'coordSystem',xZero="888.4649186451074",yZero="465.3980334757529",scale="653.3442584680625",yscale="653.3442584680623")
+ET.SubElement(_EUCLIDIAN_VIEW,'evSettings',axes="false",grid="false",gridIsBold="false",pointCapturing="3",rightAngleStyle="1",checkboxSize="26",gridType="3")
+ET.SubElement(_EUCLIDIAN_VIEW,'bgColor',r="255",g="255",b="255")
+ET.SubElement(_EUCLIDIAN_VIEW,'axesColor',r="0",g="0",b="0")
+ET.SubElement(_EUCLIDIAN_VIEW,'gridColor',r="192",g="192",b="192")
+ET.SubElement(_EUCLIDIAN_VIEW,'lineStyle',axes="1",grid="0")
+ET.SubElement(_EUCLIDIAN_VIEW,'axis',id="0",show="true",label="",unitLabel="",tickStyle="1",showNumbers="true")
+ET.SubElement(_EUCLIDIAN_VIEW,'axis',id="1",show="true",label="",unitLabel="",tickStyle="1",showNumbers="true")
+
+
 def graph_to_geogebra(G,ggb_filename):
     '''
     Converts a SageMath graph into a GeoGebra file, where vertices become points and edges become line segments.
     Vertex labels become vertex labels.
     The graph's pos dictionary is used for the position of the points.
     '''
-    with open("geogebra.xml","wt") as f:
-        f.write(r'<?xml version="1.0" encoding="utf-8"?>' +"\n")
-        f.write(r'<geogebra format="5.0">' +"\n")
-        
-        f.write(r'<euclidianView>' +"\n")
-        f.write(r'<viewNumber viewNo="1"/>' +"\n")
-        #f.write(r'<size width="2339" height="1196"/>' +"\n")
-        #f.write(r'<coordSystem xZero="888.4649186451074" yZero="465.3980334757529" scale="653.3442584680625" yscale="653.3442584680623"/>' +"\n")
-        f.write(r'<evSettings axes="false" grid="false" gridIsBold="false" pointCapturing="3" rightAngleStyle="1" checkboxSize="26" gridType="3"/>' +"\n")
-        f.write(r'<bgColor r="255" g="255" b="255"/>' +"\n")
-        f.write(r'<axesColor r="0" g="0" b="0"/>' +"\n")
-        f.write(r'<gridColor r="192" g="192" b="192"/>' +"\n")
-        f.write(r'<lineStyle axes="1" grid="0"/>' +"\n")
-        f.write(r'<axis id="0" show="true" label="" unitLabel="" tickStyle="1" showNumbers="true"/>' +"\n")
-        f.write(r'<axis id="1" show="true" label="" unitLabel="" tickStyle="1" showNumbers="true"/>' +"\n")
-        f.write(r'</euclidianView>' +"\n")
-        
-        f.write(r'<construction>' +"\n")
-        
-        pos=G.get_pos()
-        for v in G.vertices(sort=False):
-            # see if there is an object associated with v; if so, interpret it as a dictionary
-            info=G.get_vertex(v)
-            if info==None:
-                info=dict()  # empty dictionary
-            
-            f.write(f'<element type="point" label="{v}">' +"\n")  # cannot use info['label'], since this needs to match with the Sage vertex name for the edges.
-            f.write(r'<show object="true" label="true"/>' +"\n")
-            if 'color' in info:
-                f.write(f"<objColor r=\"{info['color'][0]}\""
-                                +f" g=\"{info['color'][1]}\""
-                                +f" b=\"{info['color'][2]}\""
-                            +f" alpha=\"{info['color'][3]}\"/>" +"\n")
-            else:  # default color
-                f.write(r'<objColor r="77" g="77" b="255" alpha="0"/>' +"\n")
-            f.write(r'<layer val="0"/>' +"\n")
-            f.write(r'<labelMode val="0"/>' +"\n")
-            f.write(f'<coords x="{float(pos[v][0])}" y="{float(pos[v][1])}" z="1"/>' +"\n")  # force evaluation of expressions as floats
-            if 'size' in info:
-                f.write(f"<pointSize val=\"{info['size']}\"/>" +"\n")
-            else:
-                f.write(r'<pointSize val="5"/>' +"\n")
-            if 'style' in info:
-                f.write(f"<pointStyle val=\"{info['style']}\"/>" +"\n")
-            else:
-                f.write(r'<pointStyle val="0"/>' +"\n")
-            f.write(r'</element>' +"\n")
-        
-        for e in G.edges(sort=False):
-            label=f"edge-{e[0]}-{e[1]}"
-            f.write(r'<command name="Segment">' +"\n")
-            f.write(f'<input a0="{e[0]}" a1="{e[1]}"/>' + "\n")
-            f.write(f'<output a0="{label}"/>' +"\n")
-            f.write(r'</command>' +"\n")
-            f.write(f'<element type="segment" label="{label}">' +"\n")
-            f.write(r'<show object="true" label="false"/>' +"\n")  # do not show edge label
-            f.write(r'<objColor r="0" g="0" b="0" alpha="0"/>' +"\n")
-            f.write(r'<layer val="0"/>' +"\n")
-            f.write(r'<labelMode val="0"/>' +"\n")
-            #f.write(r'<coords x="-0.8400000000000001" y="1.2800000000000002" z="4.5984"/>' +"\n")
-            f.write(r'<lineStyle thickness="5" type="0" typeHidden="1" opacity="178"/>' +"\n")
-            #f.write(r'<outlyingIntersections val="false"/>' +"\n")
-            #f.write(r'<keepTypeOnTransform val="true"/>' +"\n")
-            f.write(r'</element>' +"\n")
+    # the XML is built as an ElementTree, so that labels are escaped properly,
+    # then serialized in memory and compressed straight into the archive
+    geogebra=ET.Element('geogebra',format="5.0")
+    
+    geogebra.append(_EUCLIDIAN_VIEW)
+    
+    construction=ET.SubElement(geogebra,'construction')
+    
+    SubElement=ET.SubElement  # bound to a local, since it is called for every XML node below
+    pos=G.get_pos()
+    vertex_information=G.get_vertices()  # objects associated with all vertices, fetched in one call
+    for v in G.vertices(sort=False):
+        # see if there is an object associated with v; if so, interpret it as a dictionary
+        info=vertex_information[v]
+        if not isinstance(info,dict):  # no object, or one that is not a dictionary, such as a plain label
+            info=dict()  # empty dictionary
         
-        f.write(r'' +"\n")
-        f.write(r'</construction>' +"\n")
-        f.write(r'</geogebra>' +"\n")
-        # f.write(r'' +"\n")
+        elt=SubElement(construction,'element',type="point",label=str(v))  # cannot use info['label'], since this needs to match with the Sage vertex name for the edges.
+        SubElement(elt,'show',object="true",label="true")
+        if 'color' in info:
+            color=info['color']
+            SubElement(elt,'objColor',r=str(color[0]),g=str(color[1]),b=str(color[2]),alpha=str(color[3]))
+        else:  # default color
+            SubElement(elt,'objColor',r="77",g="77",b="255",alpha="0")
+        SubElement(elt,'layer',val="0")
+        SubElement(elt,'labelMode',val="0")
+        SubElement(elt,'coords',x=str(float(pos[v][0])),y=str(float(pos[v][1])),z="1")  # force evaluation of expressions as floats
+        SubElement(elt,'pointSize',val=str(info.get('size',5)))
+        SubElement(elt,'pointStyle',val=str(info.get('style',0)))
     
-    with zipfile.ZipFile(ggb_filename,'w') as f:
-        f.write("geogebra.xml")
+    for e in G.edges(sort=False):
+        label=f"edge-{e[0]}-{e[1]}"
+        command=SubElement(construction,'command',name="Segment")
+        SubElement(command,'input',a0=str(e[0]),a1=str(e[1]))
+        SubElement(command,'output',a0=label)
+        elt=SubElement(construction,'element',type="segment",label=label)
+        SubElement(elt,'show',object="true",label="false")  # do not show edge label
+        SubElement(elt,'objColor',r="0",g="0",b="0",alpha="0")
+        SubElement(elt,'layer',val="0")
+        SubElement(elt,'labelMode',val="0")
+        #SubElement(elt,'coords',x="-0.8400000000000001",y="1.2800000000000002",z="4.5984")
+        SubElement(elt,'lineStyle',thickness="5",type="0",typeHidden="1",opacity="178")
+        #SubElement(elt,'outlyingIntersections',val="false")
+        #SubElement(elt,'keepTypeOnTransform',val="true")
     
+    with io.BytesIO() as buf:
+        ET.ElementTree(geogebra).write(buf,encoding='utf-8',xml_declaration=True)
+        with zipfile.ZipFile(ggb_filename,'w',compression=zipfile.ZIP_DEFLATED,compresslevel=6) as z:
+            z.writestr("geogebra.xml",buf.getvalue())
+
 
 if __name__=="__main__":
     